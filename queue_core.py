@@ -1,58 +1,66 @@
 # queue_core.py
+import functools
 import json
 import os
+import select
+import sqlite3
 import time
 import uuid
 import subprocess
 from pathlib import Path
-from contextlib import contextmanager
 
 BASE_DIR = Path(__file__).parent
-DATA_FILE = BASE_DIR / "queue_data.json"
+DB_FILE = BASE_DIR / "queue.db"
+DATA_FILE = BASE_DIR / "queue_data.json"  # legacy JSON store, imported once into the db
 CONFIG_FILE = BASE_DIR / "config.json"
 WORKERS_FILE = BASE_DIR / "workers.json"
-LOCK_FILE = BASE_DIR / "queue_data.lock"
+POKE_FIFO = BASE_DIR / "queue.poke"
+
+
+_now_s = 0
+_now_str = ""
 
 
 def now_iso():
-    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    # timestamps are second-resolution, so format at most once per second
+    # instead of running strftime on every call
+    global _now_s, _now_str
+    s = int(time.time())
+    if s != _now_s:
+        tm = time.gmtime(s)
+        _now_str = f"{tm.tm_year:04d}-{tm.tm_mon:02d}-{tm.tm_mday:02d}T{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}Z"
+        _now_s = s
+    return _now_str
 
 
-@contextmanager
-def file_lock(timeout=5):
-    start = time.time()
-    while True:
-        try:
-            fd = os.open(str(LOCK_FILE), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-            os.write(fd, str(os.getpid()).encode())
-            os.close(fd)
-            break
-        except FileExistsError:
-            if time.time() - start > timeout:
-                raise TimeoutError("Could not acquire lock")
-            time.sleep(0.05)
+def write_json_atomic(path, obj, indent=None):
+    # write to a temp file and rename over the target so a crash mid-write
+    # never leaves a truncated file behind
+    path = Path(path)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    fd = os.open(str(tmp), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
     try:
-        yield
+        os.write(fd, json.dumps(obj, indent=indent).encode())
+        os.fsync(fd)
     finally:
-        try:
-            os.remove(str(LOCK_FILE))
-        except FileNotFoundError:
-            pass
+        os.close(fd)
+    os.replace(tmp, path)
 
 
+@functools.lru_cache(maxsize=1)
 def load_config():
+    # parsed once per process; `queue_ctl config set` calls
+    # load_config.cache_clear() after writing
     if CONFIG_FILE.exists():
         with open(CONFIG_FILE, "r") as f:
             return json.load(f)
     default = {"max_retries": 3, "backoff_base": 2}
-    with open(CONFIG_FILE, "w") as f:
-        json.dump(default, f, indent=2)
+    write_json_atomic(CONFIG_FILE, default, indent=2)
     return default
 
 
 def save_workers(pids):
-    with open(WORKERS_FILE, "w") as f:
-        json.dump({"pids": pids}, f)
+    write_json_atomic(WORKERS_FILE, {"pids": pids})
 
 
 def load_workers():
@@ -63,9 +71,14 @@ def load_workers():
 
 
 class Job:
-    def __init__(self, *, id=None, command=None, state="pending", attempts=0, max_retries=None, created_at=None, updated_at=None):
+    # fixed attribute slots: roughly halves per-instance memory vs a __dict__,
+    # which matters when list_jobs materializes every record
+    __slots__ = ("id", "command", "argv", "state", "attempts", "max_retries", "created_at", "updated_at")
+
+    def __init__(self, *, id=None, command=None, argv=None, state="pending", attempts=0, max_retries=None, created_at=None, updated_at=None):
         self.id = id or uuid.uuid4().hex
         self.command = command or ""
+        self.argv = argv  # pre-split token list; when set the worker skips the shell
         self.state = state  # pending, processing, completed, failed, dead
         self.attempts = attempts
         self.max_retries = max_retries  # allow override per job; if None use config
@@ -76,6 +89,7 @@ class Job:
         return {
             "id": self.id,
             "command": self.command,
+            "argv": self.argv,
             "state": self.state,
             "attempts": self.attempts,
             "max_retries": self.max_retries,
@@ -88,6 +102,7 @@ class Job:
         return Job(
             id=d.get("id"),
             command=d.get("command"),
+            argv=d.get("argv"),
             state=d.get("state", "pending"),
             attempts=d.get("attempts", 0),
             max_retries=d.get("max_retries"),
@@ -96,130 +111,230 @@ class Job:
         )
 
 
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    command TEXT NOT NULL,
+    argv TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_retries INTEGER,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dlq (
+    id TEXT PRIMARY KEY,
+    command TEXT NOT NULL,
+    argv TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_retries INTEGER,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state);
+CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs (created_at);
+-- partial index over only the pending rows, in claim order, so picking the
+-- next job never scans processing jobs that have piled up
+CREATE INDEX IF NOT EXISTS idx_jobs_pending ON jobs (created_at) WHERE state = 'pending';
+"""
+
+JOB_COLUMNS = "(id, command, argv, state, attempts, max_retries, created_at, updated_at)"
+
+
+def _row_to_dict(row):
+    # argv is stored as a JSON array in a TEXT column; decode it on the way out
+    d = dict(row)
+    if d.get("argv"):
+        d["argv"] = json.loads(d["argv"])
+    return d
+
+
 class JobStore:
-    def __init__(self):
-        self.data_file = DATA_FILE
-        if not self.data_file.exists():
-            self._init_file()
-        self.config = load_config()
-
-    def _init_file(self):
-        empty = {"jobs": [], "dlq": []}
-        with open(self.data_file, "w") as f:
-            json.dump(empty, f, indent=2)
-
-    def _read(self):
-        with open(self.data_file, "r") as f:
-            return json.load(f)
+    def __init__(self, config=None):
+        self.db_file = DB_FILE
+        first_run = not self.db_file.exists()
+        # autocommit mode: each statement is its own transaction, so the
+        # single-statement claim below is atomic across processes via WAL
+        self.conn = sqlite3.connect(str(self.db_file), isolation_level=None, timeout=5)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # read pages straight from the OS page cache instead of read() syscalls
+        self.conn.execute("PRAGMA mmap_size=134217728")
+        self.conn.executescript(SCHEMA)
+        for table in ("jobs", "dlq"):
+            cols = [r[1] for r in self.conn.execute(f"PRAGMA table_info({table})")]
+            if "argv" not in cols:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN argv TEXT")
+        if first_run:
+            self._import_legacy_json()
+        self.config = config or load_config()
+        self._poke_fd = None  # opened lazily by wait_for_job
+
+    def _import_legacy_json(self):
+        # one-time migration from the old queue_data.json layout
+        if not DATA_FILE.exists():
+            return
+        try:
+            with open(DATA_FILE, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        for j in data.get("jobs", []):
+            self._insert("jobs", Job.from_dict(j))
+        for j in data.get("dlq", []):
+            self._insert("dlq", Job.from_dict(j))
 
-    def _write(self, obj):
-        with open(self.data_file, "w") as f:
-            json.dump(obj, f, indent=2)
+    def _insert(self, table, job: Job):
+        argv = json.dumps(job.argv) if job.argv else None
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO {table} {JOB_COLUMNS} VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job.id, job.command, argv, job.state, job.attempts, job.max_retries, job.created_at, job.updated_at),
+        )
 
     def enqueue(self, job: Job):
-        with file_lock():
-            data = self._read()
-            data["jobs"].append(job.to_dict())
-            self._write(data)
+        self._insert("jobs", job)
+        self._poke()
 
-    def list_jobs(self, state=None):
-        with file_lock():
-            data = self._read()
-            jobs = [Job.from_dict(j) for j in data.get("jobs", [])]
+    def _poke(self):
+        # wake one idle worker blocked in wait_for_job; best effort only
+        if not hasattr(os, "mkfifo"):
+            return
+        try:
+            fd = os.open(str(POKE_FIFO), os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            # fifo missing or no worker listening; workers fall back to their
+            # wait timeout
+            return
+        try:
+            os.write(fd, b"x")
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def wait_for_job(self, timeout=0.5, extra_fds=()):
+        # block until an enqueuer pokes the fifo, any of extra_fds becomes
+        # readable, or the timeout passes
+        if not hasattr(os, "mkfifo"):
+            time.sleep(timeout)
+            return
+        if self._poke_fd is None:
+            try:
+                os.mkfifo(str(POKE_FIFO))
+            except FileExistsError:
+                pass
+            # O_RDWR keeps a writer open on our side so the read end never
+            # sees EOF (which would make select() spin)
+            self._poke_fd = os.open(str(POKE_FIFO), os.O_RDWR | os.O_NONBLOCK)
+        ready, _, _ = select.select([self._poke_fd, *extra_fds], [], [], timeout)
+        if self._poke_fd in ready:
+            try:
+                os.read(self._poke_fd, 1024)  # drain
+            except OSError:
+                pass
+
+    def list_job_dicts(self, state=None):
+        # raw dicts for callers that only display/serialize (the CLI);
+        # skips one Job object allocation per record
         if state:
-            return [j for j in jobs if j.state == state]
-        return jobs
+            rows = self.conn.execute("SELECT * FROM jobs WHERE state = ?", (state,))
+        else:
+            rows = self.conn.execute("SELECT * FROM jobs")
+        return [_row_to_dict(r) for r in rows]
+
+    def list_jobs(self, state=None):
+        return [Job.from_dict(d) for d in self.list_job_dicts(state)]
+
+    def list_dlq_dicts(self):
+        return [_row_to_dict(r) for r in self.conn.execute("SELECT * FROM dlq")]
 
     def list_dlq(self):
-        with file_lock():
-            data = self._read()
-            return [Job.from_dict(j) for j in data.get("dlq", [])]
+        return [Job.from_dict(d) for d in self.list_dlq_dicts()]
 
     def claim_job(self, worker_id=None):
-        with file_lock():
-            data = self._read()
-            for idx, j in enumerate(data.get("jobs", [])):
-                if j.get("state") == "pending":
-                    job = Job.from_dict(j)
-                    job.state = "processing"
-                    job.updated_at = now_iso()
-                    # write back
-                    data["jobs"][idx] = job.to_dict()
-                    self._write(data)
-                    return job
+        # single-statement atomic claim: pick the oldest pending job and flip
+        # it to processing without any explicit lock
+        row = self.conn.execute(
+            "UPDATE jobs SET state = 'processing', updated_at = ? "
+            "WHERE id = (SELECT id FROM jobs INDEXED BY idx_jobs_pending "
+            "WHERE state = 'pending' ORDER BY created_at LIMIT 1) RETURNING *",
+            (now_iso(),),
+        ).fetchone()
+        if row is None:
             return None
+        return Job.from_dict(_row_to_dict(row))
+
+    def claim_batch(self, limit: int, worker_id=None):
+        # claim up to `limit` pending jobs in one statement so the transaction
+        # cost is paid once per batch instead of once per job
+        rows = self.conn.execute(
+            "UPDATE jobs SET state = 'processing', updated_at = ? "
+            "WHERE id IN (SELECT id FROM jobs INDEXED BY idx_jobs_pending "
+            "WHERE state = 'pending' ORDER BY created_at LIMIT ?) RETURNING *",
+            (now_iso(), limit),
+        ).fetchall()
+        rows.sort(key=lambda r: r["created_at"])
+        return [Job.from_dict(_row_to_dict(r)) for r in rows]
 
     def update_job_after_run(self, job: Job, success: bool, move_to_dlq=False):
-        with file_lock():
-            data = self._read()
-            # find job in jobs by id
-            found_idx = None
-            for idx, j in enumerate(data.get("jobs", [])):
-                if j.get("id") == job.id:
-                    found_idx = idx
-                    break
-
-            if success:
-                # remove from jobs list
-                if found_idx is not None:
-                    data["jobs"].pop(found_idx)
-                # no separate completed list required by spec; state will be stored in record if wanted
-            else:
-                if move_to_dlq:
-                    # remove from jobs list and add to dlq
-                    if found_idx is not None:
-                        data["jobs"].pop(found_idx)
-                    job.state = "dead"
-                    job.updated_at = now_iso()
-                    data.setdefault("dlq", []).append(job.to_dict())
-                else:
-                    # put back as pending
-                    if found_idx is not None:
-                        data["jobs"][found_idx] = job.to_dict()
-                    else:
-                        data.setdefault("jobs", []).append(job.to_dict())
-
-            self._write(data)
+        if success:
+            self.conn.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+        elif move_to_dlq:
+            # IMMEDIATE takes the write lock up front under the busy timeout;
+            # a deferred BEGIN could hit SQLITE_BUSY_SNAPSHOT on upgrade
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+                job.state = "dead"
+                job.updated_at = now_iso()
+                self._insert("dlq", job)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        else:
+            # put back as pending (state already set by caller)
+            self._insert("jobs", job)
+            self._poke()
 
     def remove_dlq_job(self, job_id):
-        with file_lock():
-            data = self._read()
-            new_dlq = [j for j in data.get("dlq", []) if j.get("id") != job_id]
-            data["dlq"] = new_dlq
-            self._write(data)
+        self.conn.execute("DELETE FROM dlq WHERE id = ?", (job_id,))
 
     def requeue_dlq_job(self, job_id):
-        with file_lock():
-            data = self._read()
-            match = None
-            for idx, j in enumerate(data.get("dlq", [])):
-                if j.get("id") == job_id:
-                    match = j
-                    data["dlq"].pop(idx)
-                    break
-            if match:
-                match["state"] = "pending"
-                match["updated_at"] = now_iso()
-                data.setdefault("jobs", []).append(match)
-                self._write(data)
-                return True
-            return False
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute("SELECT * FROM dlq WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                self.conn.execute("ROLLBACK")
+                return False
+            job = Job.from_dict(_row_to_dict(row))
+            job.state = "pending"
+            job.updated_at = now_iso()
+            self.conn.execute("DELETE FROM dlq WHERE id = ?", (job_id,))
+            self._insert("jobs", job)
+            self.conn.execute("COMMIT")
+            self._poke()
+            return True
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
 
     def counts(self):
-        with file_lock():
-            data = self._read()
-            jobs = data.get("jobs", [])
-            dlq = data.get("dlq", [])
-            pending = sum(1 for j in jobs if j.get("state") == "pending")
-            processing = sum(1 for j in jobs if j.get("state") == "processing")
-            completed = 0  # we don't keep a separate completed list in this simple design
-            failed = len(dlq)
-            return {"pending": pending, "processing": processing, "failed": failed, "total_jobs": len(jobs)}
+        by_state = dict(self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        failed = self.conn.execute("SELECT COUNT(*) FROM dlq").fetchone()[0]
+        total = sum(by_state.values())
+        return {
+            "pending": by_state.get("pending", 0),
+            "processing": by_state.get("processing", 0),
+            "failed": failed,
+            "total_jobs": total,
+        }
 
     def get_job(self, job_id):
-        with file_lock():
-            data = self._read()
-            for j in data.get("jobs", []) + data.get("dlq", []):
-                if j.get("id") == job_id:
-                    return Job.from_dict(j)
+        for table in ("jobs", "dlq"):
+            row = self.conn.execute(f"SELECT * FROM {table} WHERE id = ?", (job_id,)).fetchone()
+            if row is not None:
+                return Job.from_dict(_row_to_dict(row))
         return None
@@ -1,14 +1,62 @@
 # queue_ctl.py
 import argparse
+import collections
 import json
 import os
+import select
+import shlex
 import signal
 import subprocess
 import sys
 import time
-from queue_core import Job, JobStore, DATA_FILE, WORKERS_FILE, BASE_DIR, load_config, save_workers, load_workers
+import traceback
+from queue_core import Job, JobStore, now_iso, DATA_FILE, WORKERS_FILE, BASE_DIR, load_config, save_workers, load_workers, write_json_atomic
 
-PY = sys.executable  
+PY = sys.executable
+
+STOP_FIFO = BASE_DIR / "workers.stop"
+
+
+def open_stop_fd():
+    # shared fifo all workers watch for shutdown; None where fifos don't exist
+    if not hasattr(os, "mkfifo"):
+        return None
+    try:
+        os.mkfifo(str(STOP_FIFO))
+    except FileExistsError:
+        pass
+    # O_RDWR so the fifo always has a writer and reads never return EOF
+    return os.open(str(STOP_FIFO), os.O_RDWR | os.O_NONBLOCK)
+
+
+def stop_requested(stop_fd):
+    if stop_fd is None:
+        return False
+    ready, _, _ = select.select([stop_fd], [], [], 0)
+    if ready:
+        try:
+            os.read(stop_fd, 1)
+        except BlockingIOError:
+            # another worker consumed the byte between select and read
+            return False
+        return True
+    return False
+
+
+# commands containing any of these need a shell to keep their meaning
+# (pipes, redirects, chaining, globs, variable expansion, ...)
+SHELL_CHARS = set("|&;<>()$`*?{}[]~#\\\n")
+
+
+def split_command(command, force_shell=False):
+    # pre-split plain commands into an argv list so the worker can skip the
+    # per-job /bin/sh fork; anything shell-flavoured stays a shell string
+    if force_shell or not command or SHELL_CHARS.intersection(command):
+        return None
+    try:
+        return shlex.split(command) or None
+    except ValueError:
+        return None
 
 
 def enqueue_command(args):
@@ -17,36 +65,50 @@ def enqueue_command(args):
     if args.json:
         try:
             jobdict = json.loads(args.json)
-            job = Job(command=jobdict.get("command") or jobdict.get("cmd"), max_retries=jobdict.get("max_retries"))
+            command = jobdict.get("command") or jobdict.get("cmd")
+            job = Job(command=command, argv=split_command(command, force_shell=args.shell),
+                      max_retries=jobdict.get("max_retries"))
         except Exception as e:
             print("Invalid JSON for enqueue:", e)
             return
     else:
-        job = Job(command=args.command, max_retries=args.max_retries)
+        job = Job(command=args.command, argv=split_command(args.command, force_shell=args.shell),
+                  max_retries=args.max_retries)
     store.enqueue(job)
     print("Enqueued:", job.id)
 
 
-def run_worker_loop(worker_id, backoff_base, default_max_retries):
+def run_worker_loop(worker_id, backoff_base, default_max_retries, batch_size=10):
     store = JobStore()
     print(f"[worker-{worker_id}] started (pid={os.getpid()})")
-    stop_file = BASE_DIR / f"worker_{worker_id}.stop"
+    stop_fd = open_stop_fd()
+    stop_file = BASE_DIR / f"worker_{worker_id}.stop"  # fallback where fifos don't exist
+    claimed = collections.deque()
     try:
         while True:
-            if stop_file.exists():
-                print(f"[worker-{worker_id}] stop file detected; exiting after current job.")
+            if stop_requested(stop_fd) or (stop_fd is None and stop_file.exists()):
+                print(f"[worker-{worker_id}] stop requested; exiting after current job.")
                 break
-            job = store.claim_job(worker_id=worker_id)
-            if not job:
-                time.sleep(0.5)
+            if not claimed:
+                # claim a batch at a time so the transaction cost is shared
+                claimed.extend(store.claim_batch(batch_size, worker_id=worker_id))
+            if not claimed:
+                # block on the poke fifo instead of blind-sleeping; an enqueue
+                # (or a stop byte) wakes us immediately, otherwise we re-check
+                # after 0.5 s
+                store.wait_for_job(timeout=0.5, extra_fds=() if stop_fd is None else (stop_fd,))
                 continue
+            job = claimed.popleft()
             # determine job max_retries
             job_max = job.max_retries if job.max_retries is not None else default_max_retries
             print(f"[worker-{worker_id}] picked job {job.id} -> {job.command}")
-            # run the command
+            # run the command; plain commands were pre-split at enqueue time
+            # so we can exec them directly without forking a shell
             try:
-                # run with shell so commands like sleep / echo work
-                proc = subprocess.run(job.command, shell=True)
+                if job.argv:
+                    proc = subprocess.run(job.argv)
+                else:
+                    proc = subprocess.run(job.command, shell=True)
                 success = (proc.returncode == 0)
             except Exception as e:
                 print(f"[worker-{worker_id}] exception running command: {e}")
@@ -54,19 +116,21 @@ def run_worker_loop(worker_id, backoff_base, default_max_retries):
 
             if success:
                 job.state = "completed"
-                job.updated_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+                job.updated_at = now_iso()
                 store.update_job_after_run(job, success=True)
                 print(f"[worker-{worker_id}] job {job.id} completed.")
             else:
                 job.attempts += 1
-                job.updated_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+                job.updated_at = now_iso()
                 if job.attempts >= job_max:
                     # move to dlq
                     print(f"[worker-{worker_id}] job {job.id} failed permanently (attempts={job.attempts}). Moving to DLQ.")
                     store.update_job_after_run(job, success=False, move_to_dlq=True)
                 else:
-                    # backoff
-                    delay = (backoff_base ** (job.attempts - 1))
+                    # backoff; shift for the default base 2 (capped so the
+                    # delay can't overflow into something absurd)
+                    exp = min(job.attempts - 1, 62)
+                    delay = (1 << exp) if backoff_base == 2 else backoff_base ** exp
                     print(f"[worker-{worker_id}] job {job.id} failed — retrying after {delay}s (attempt {job.attempts}/{job_max})")
                     # set state back to pending and update attempts/time
                     job.state = "pending"
@@ -74,6 +138,17 @@ def run_worker_loop(worker_id, backoff_base, default_max_retries):
                     time.sleep(delay)
     except KeyboardInterrupt:
         print(f"[worker-{worker_id}] interrupted; exiting")
+    finally:
+        # release any batch-claimed jobs we never started, otherwise they
+        # stay 'processing' forever with no worker attached
+        while claimed:
+            job = claimed.popleft()
+            job.state = "pending"
+            job.updated_at = now_iso()
+            store.update_job_after_run(job, success=False, move_to_dlq=False)
+            print(f"[worker-{worker_id}] released unstarted job {job.id} back to pending.")
+        if stop_fd is not None:
+            os.close(stop_fd)
     print(f"[worker-{worker_id}] exiting.")
 
 
@@ -82,35 +157,61 @@ def worker_start(args):
     config = load_config()
     pids = []
     for i in range(count):
-        # launch new python process running this script with subcommand 'worker-process'
-        cmd = [PY, os.path.join(os.path.dirname(__file__), "queue_ctl.py"), "worker-process", "--id", str(int(time.time()*1000) % 100000 + i)]
-        # detach / background
+        worker_id = str(int(time.time() * 1000) % 100000 + i)
         if os.name == "nt":
-            # windows
+            # windows: launch a fresh interpreter running 'worker-process'
+            cmd = [PY, os.path.join(os.path.dirname(__file__), "queue_ctl.py"), "worker-process", "--id", worker_id]
             proc = subprocess.Popen(cmd, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+            pid = proc.pid
         else:
-            proc = subprocess.Popen(cmd)
-        pids.append(proc.pid)
-        print("Started worker pid:", proc.pid)
+            # fork instead of re-execing python: the child starts with imports
+            # already warm, skipping interpreter startup per worker
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    worker_process_main(argparse.Namespace(id=worker_id))
+                except BaseException:
+                    # without this a crashed worker would _exit(0) silently
+                    traceback.print_exc()
+                    os._exit(1)
+                os._exit(0)
+        pids.append(pid)
+        print("Started worker pid:", pid)
     # save pids
     save_workers(pids)
 
 
 def worker_stop(args):
-    # read pids and terminate
     pids = load_workers()
     if not pids:
         print("No workers running.")
         return
-    for pid in pids:
-        try:
-            print("Stopping pid", pid)
-            if os.name == "nt":
+    if os.name == "nt":
+        for pid in pids:
+            try:
+                print("Stopping pid", pid)
                 subprocess.run(["taskkill", "/PID", str(pid), "/F"])
-            else:
-                os.kill(pid, signal.SIGTERM)
-        except Exception as e:
-            print("Error stopping pid", pid, e)
+            except Exception as e:
+                print("Error stopping pid", pid, e)
+    else:
+        # one stop byte per worker on the shared fifo; each worker consumes
+        # one and exits after its current job
+        try:
+            fd = os.open(str(STOP_FIFO), os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            fd = None
+        if fd is not None:
+            os.write(fd, b"s" * len(pids))
+            os.close(fd)
+            print("Stop signal sent to", len(pids), "worker(s).")
+        else:
+            # no worker has the fifo open; fall back to SIGTERM
+            for pid in pids:
+                try:
+                    print("Stopping pid", pid)
+                    os.kill(pid, signal.SIGTERM)
+                except Exception as e:
+                    print("Error stopping pid", pid, e)
     # remove workers file
     if os.path.exists(WORKERS_FILE):
         os.remove(WORKERS_FILE)
@@ -121,8 +222,9 @@ def worker_process_main(args):
     cfg = load_config()
     backoff_base = cfg.get("backoff_base", 2)
     default_max_retries = cfg.get("max_retries", 3)
+    batch_size = cfg.get("batch_size", 10)
     worker_id = args.id or str(os.getpid())
-    run_worker_loop(worker_id, backoff_base, default_max_retries)
+    run_worker_loop(worker_id, backoff_base, default_max_retries, batch_size=batch_size)
 
 
 def cmd_status(args):
@@ -139,23 +241,22 @@ def cmd_status(args):
 
 def cmd_list(args):
     store = JobStore()
-    state = args.state
-    jobs = store.list_jobs(state=state)
+    jobs = store.list_job_dicts(state=args.state)
     if not jobs:
         print("No jobs found.")
         return
     for j in jobs:
-        print(json.dumps(j.to_dict(), indent=2))
+        print(json.dumps(j, indent=2))
 
 
 def cmd_dlq_list(args):
     store = JobStore()
-    jobs = store.list_dlq()
+    jobs = store.list_dlq_dicts()
     if not jobs:
         print("DLQ empty.")
         return
     for j in jobs:
-        print(json.dumps(j.to_dict(), indent=2))
+        print(json.dumps(j, indent=2))
 
 
 def cmd_dlq_retry(args):
@@ -183,8 +284,8 @@ def cmd_config(args):
         except Exception:
             pass
         cfg[key] = val
-        with open(os.path.join(os.path.dirname(__file__), "config.json"), "w") as f:
-            json.dump(cfg, f, indent=2)
+        write_json_atomic(os.path.join(os.path.dirname(__file__), "config.json"), cfg, indent=2)
+        load_config.cache_clear()
         print("Config updated.")
 
 
@@ -198,6 +299,7 @@ def main():
     group.add_argument("--json", help="Job JSON string (e.g. '{\"command\":\"sleep 2\"}')")
     group.add_argument("--command", help="Simple command string to run (shell).")
     p.add_argument("--max-retries", type=int, help="Override max_retries for this job.")
+    p.add_argument("--shell", action="store_true", help="Always run this job through the shell (skipped automatically for plain commands).")
 
     # worker management
     p = sub.add_parser("worker")